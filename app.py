@@ -1,9 +1,11 @@
 # app_delivery_quote.py — Modern UI (small map + purple primary button + bullet summary)
 import streamlit as st
-import pandas as pd
-import pydeck as pdk
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
-import time, hmac, hashlib, uuid, json, re
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import time, hmac, hashlib, itertools, json, re, secrets
+import concurrent.futures
 from urllib.parse import urlparse, parse_qs, unquote
 
 # =========================
@@ -20,45 +22,105 @@ SHOP_ADDR = "Metro park สาทร"
 SHOP_LAT  = 13.709679
 SHOP_LNG  = 100.449409
 
+# =========================
+# HTTP (pooled session, reused across reruns)
+# =========================
+@st.cache_resource
+def _http():
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                    max_retries=Retry(total=2, backoff_factor=0.2,
+                                                      status_forcelist=[429, 502, 503, 504])))
+    s.headers["Connection"] = "keep-alive"
+    s.headers.update({"User-Agent": "SugarShade-Lalamove-Helper",
+                      "Accept-Encoding": "gzip",
+                      "Accept": "application/json"})
+    return s
+
+@st.cache_resource
+def _pool():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
 # =========================
 # LALAMOVE HELPERS (v3)
 # =========================
+_HMAC_PROTO = hmac.new(API_SECRET.encode("utf-8"), b"", hashlib.sha256)  # key schedule computed once
+_RID_PREFIX = secrets.token_hex(8)  # per-process random part; the counter keeps IDs unique
+_rid_counter = itertools.count()
 def _now_ms(): return str(int(time.time()*1000))
-def _compact(o): return json.dumps(o, separators=(",", ":"), ensure_ascii=False)
-def _sig(secret, method, url, body, ts_ms):
-    path = urlparse(url).path
-    payload = _compact(body) if body else ""
-    raw = f"{ts_ms}\r\n{method.upper()}\r\n{path}\r\n\r\n{payload}"
-    return hmac.new(secret.encode("utf-8"), raw.encode("utf-8"), hashlib.sha256).hexdigest()
-def _headers(method, url, body):
+try:  # orjson is optional but much faster on Thai (non-ASCII) payloads
+    import orjson
+    def _compact_bytes(o): return orjson.dumps(o)
+    def _compact(o): return orjson.dumps(o).decode("utf-8")
+    def _loads(b): return orjson.loads(b)
+except ImportError:
+    def _compact(o): return json.dumps(o, separators=(",", ":"), ensure_ascii=False)
+    def _compact_bytes(o): return _compact(o).encode("utf-8")
+    def _loads(b): return json.loads(b)
+_SIGN_MIDS = {("POST", "/v3/quotations"): b"\r\nPOST\r\n/v3/quotations\r\n\r\n"}
+def _sig(method, path, payload_bytes, ts_ms):
+    mu = method.upper()
+    mid = _SIGN_MIDS.get((mu, path)) or f"\r\n{mu}\r\n{path}\r\n\r\n".encode("utf-8")
+    mac = _HMAC_PROTO.copy()
+    mac.update(ts_ms.encode("ascii"))
+    mac.update(mid)
+    mac.update(payload_bytes)
+    return mac.hexdigest()
+def _headers(method, path, payload_bytes):
     ts = _now_ms()
     return {
         "Content-Type": "application/json; charset=UTF-8",
         "Accept": "application/json",
-        "Authorization": f"hmac {API_KEY}:{ts}:{_sig(API_SECRET, method, url, body, ts)}",
+        "Authorization": f"hmac {API_KEY}:{ts}:{_sig(method, path, payload_bytes, ts)}",
         "Market": MARKET,
-        "Request-ID": str(uuid.uuid4()),
+        "Request-ID": f"{_RID_PREFIX}-{next(_rid_counter):x}-{int(time.time())}",
     }
 def llm(method, path, body=None, timeout=20):
     url = f"{BASE_URL}{path}"
-    r = requests.request(method.upper(), url, headers=_headers(method, url, body),
-                         data=_compact(body) if body else None, timeout=timeout)
-    try: data = r.json()
-    except Exception: data = {"raw": r.text}
+    payload_bytes = _compact_bytes(body) if body else b""
+    r = _http().request(method.upper(), url, headers=_headers(method, path, payload_bytes),
+                        data=payload_bytes or None, timeout=timeout)
+    raw = r.content
+    if not raw: data = {}
+    else:
+        try: data = _loads(raw)
+        except Exception: data = {"raw": raw.decode("utf-8", "replace")}
     if not r.ok: raise RuntimeError(_compact({"status": r.status_code, "error": data}))
     return data
-def get_quotation(stops, service_type, language="th_TH", item=None, scheduleAt=None, isRouteOptimized=None):
-    payload = {"data": {"serviceType": service_type, "language": language, "stops": stops}}
-    if item is not None: payload["data"]["item"] = item
-    if scheduleAt is not None: payload["data"]["scheduleAt"] = scheduleAt
-    if isRouteOptimized is not None: payload["data"]["isRouteOptimized"] = isRouteOptimized
+@st.cache_data(ttl=120, show_spinner=False)
+def _quote_cached(stops_key, service_type, language, item_key, schedule_at, route_optimized):
+    payload = {"data": {"serviceType": service_type, "language": language, "stops": json.loads(stops_key)}}
+    if item_key is not None: payload["data"]["item"] = json.loads(item_key)
+    if schedule_at is not None: payload["data"]["scheduleAt"] = schedule_at
+    if route_optimized is not None: payload["data"]["isRouteOptimized"] = route_optimized
     return llm("POST", "/v3/quotations", payload).get("data", {})
+def get_quotation(stops, service_type, language="th_TH", item=None, scheduleAt=None, isRouteOptimized=None):
+    return _quote_cached(_compact(stops), service_type, language,
+                         _compact(item) if item is not None else None,
+                         scheduleAt, isRouteOptimized)
+
+QUOTE_ITEM = {"quantity":"1","weight":"LESS_THAN_3_KG","categories":["FOOD_DELIVERY"],"handlingInstructions":["KEEP_UPRIGHT"]}
+_SHOP_COORDS = {"lat": format(SHOP_LAT, ".6f"), "lng": format(SHOP_LNG, ".6f")}
+_SHOP_STOP = {"coordinates": _SHOP_COORDS, "address": SHOP_ADDR}
+def _build_stops(sel):
+    label = sel["label"][:120]  # truncate before the payload is compacted/signed
+    # fixed 6-decimal coords (sub-meter) keep the payload canonical so the quote cache hits
+    return [_SHOP_STOP, {"coordinates":{"lat": format(sel["lat"], ".6f"), "lng": format(sel["lng"], ".6f")},"address":label}]
+def _prefetch_quotes(sel):
+    stops = _build_stops(sel)
+    ctx = get_script_run_ctx()
+    def _run(svc):
+        add_script_run_ctx(ctx=ctx)  # pool threads have no ScriptRunContext of their own
+        return get_quotation(stops, svc, "th_TH", QUOTE_ITEM, None, False)
+    return {svc: _pool().submit(_run, svc) for svc in ("MOTORCYCLE", "CAR")}
 
 # =========================
 # SMART PARSER (GMAPS + COORDS) + OSM
 # =========================
 SHORT_GMAP_HOSTS = ("maps.app.goo.gl", "goo.gl", "g.page", "g.co", "goo.gl/maps")
 COORD_RE = re.compile(r"(?P<lat>[-+]?\d{1,3}\.\d+)[ ,]+(?P<lng>[-+]?\d{1,3}\.\d+)")
+_GMAPS_COORD_RE = re.compile(r"(?:@|[?&](?:q|query|center)=)([-+]?\d{1,3}\.\d+),([-+]?\d{1,3}\.\d+)")
+_PLACE_COORD_RE = re.compile(r"^[-+]?\d{1,3}\.\d+,\s*[-+]?\d{1,3}\.\d+$")
 
 def parse_coords(text: str):
     if not text: return None
@@ -70,11 +132,19 @@ def parse_coords(text: str):
     except Exception: pass
     return None
 
+@st.cache_data(ttl=86400, show_spinner=False)
+def _expand_shortlink_cached(url):
+    # failures raise and are NOT cached (st.cache_data only memoizes successful returns)
+    ua = {"User-Agent":"Mozilla/5.0 (SugarShade-LLM Hybrid)"}
+    resp = _http().head(url, headers=ua, timeout=10, allow_redirects=True)
+    if resp.status_code == 405:  # host refuses HEAD: redirect via GET but never read the body
+        with _http().get(url, headers=ua, timeout=10, allow_redirects=True, stream=True) as resp:
+            return resp.url or url
+    return resp.url or url
+
 def expand_gmaps_shortlink(url: str) -> str:
     try:
-        resp = requests.get(url, headers={"User-Agent":"Mozilla/5.0 (SugarShade-LLM Hybrid)"},
-                            timeout=10, allow_redirects=True)
-        return resp.url or url
+        return _expand_shortlink_cached(url)
     except Exception:
         return url
 
@@ -86,12 +156,8 @@ def extract_coords_and_name_from_gmaps(url: str):
         url = expand_gmaps_shortlink(url)
 
     lat = lng = None
-    m = re.search(r"@([-+]?\d{1,3}\.\d+),([-+]?\d{1,3}\.\d+)", url)
+    m = _GMAPS_COORD_RE.search(url)
     if m: lat, lng = float(m.group(1)), float(m.group(2))
-    if lat is None:
-        for key in ("q=", "query=", "center="):
-            m = re.search(key + r"([-+]?\d{1,3}\.\d+),([-+]?\d{1,3}\.\d+)", url)
-            if m: lat, lng = float(m.group(1)), float(m.group(2)); break
 
     name = None
     parsed = urlparse(url)
@@ -103,17 +169,38 @@ def extract_coords_and_name_from_gmaps(url: str):
         for k in ("q","query","destination"):
             if k in qs:
                 val = qs[k][0]
-                if not re.match(r"^[-+]?\d{1,3}\.\d+,\s*[-+]?\d{1,3}\.\d+$", val):
+                if not _PLACE_COORD_RE.match(val):
                     name = unquote(val.replace("+"," ")).strip(); break
     return lat, lng, name
 
+_GEOCODE_MIN_INTERVAL = 1.0  # Nominatim policy: max 1 request/second
+
+@st.cache_resource
+def _nominatim_last_ts():
+    # must outlive script reruns (module globals are rebound every run) and is shared across sessions
+    return [0.0]
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _geocode_cached(query, country, limit):
+    # only true cache misses reach here, so only real outbound calls pay the rate limit
+    last = _nominatim_last_ts()
+    wait = _GEOCODE_MIN_INTERVAL - (time.monotonic() - last[0])
+    if wait > 0: time.sleep(wait)
+    last[0] = time.monotonic()
+    r = _http().get("https://nominatim.openstreetmap.org/search",
+                    params={"q":query,"format":"json","limit":limit,"countrycodes":country},
+                    timeout=10)
+    r.raise_for_status()
+    return [{"label":it.get("display_name",""),"lat":float(it["lat"]),"lng":float(it["lon"])} for it in _loads(r.content)]
 def geocode_osm(query, country="th", limit=8):
     if not query or len(query.strip()) < 3: return []
-    r = requests.get("https://nominatim.openstreetmap.org/search",
-                     params={"q":query,"format":"json","limit":limit,"countrycodes":country},
-                     headers={"User-Agent":"SugarShade-Lalamove-Helper"}, timeout=10)
-    r.raise_for_status()
-    return [{"label":it.get("display_name",""),"lat":float(it["lat"]),"lng":float(it["lon"])} for it in r.json()]
+    ss = st.session_state
+    now = time.monotonic()
+    if query == ss.get("_last_geo_q") and now - ss.get("_last_geo_ts", 0.0) < _GEOCODE_MIN_INTERVAL:
+        return ss.get("_last_geo_result", [])  # debounce accidental double-clicks
+    res = _geocode_cached(query, country, limit)
+    ss["_last_geo_q"], ss["_last_geo_ts"], ss["_last_geo_result"] = query, now, res
+    return res
 
 def resolve_destination(text: str, country="th"):
     c = parse_coords(text)
@@ -129,12 +216,10 @@ def resolve_destination(text: str, country="th"):
     return {"lat": first["lat"], "lng": first["lng"], "label": first["label"], "source": "osm"}
 
 # =========================
-# UI
+# STATIC UI (built once at import, reruns only pass references)
 # =========================
-st.set_page_config(page_title="เช็คค่าส่ง", page_icon="🛵🚗", layout="wide")
-
 # Styling (purple primary button + compact map area)
-st.markdown("""
+_PAGE_CSS = """
 <style>
 :root { --card-bg:#fff; --muted:#6b7280; --accent:#7c3aed; --border:#e5e7eb; }
 html, body, [class*="css"] { font-family: ui-sans-serif, system-ui, -apple-system, "Segoe UI", Roboto, "Helvetica Neue", Arial; }
@@ -144,35 +229,67 @@ html, body, [class*="css"] { font-family: ui-sans-serif, system-ui, -apple-syste
 .result-card{ border:1px solid var(--border); border-radius:12px; padding:14px 16px; background:#fafafa; }
 div.stButton > button[kind="primary"]{ background:#7c3aed; color:#fff; border:0; border-radius:12px; padding:14px 18px; font-weight:800; }
 </style>
-""", unsafe_allow_html=True)
+"""
 
-st.markdown(f"""
+_HEADER_HTML = f"""
 <div class="card">
   <div class="headline">เช็คค่าส่ง🛵🚗</div>
   <div class="subtle">จุดรับจาก <b>{SHOP_NAME}</b> — {SHOP_ADDR}</div>
 </div>
-""", unsafe_allow_html=True)
+"""
+
+_DISCLAIMER_HTML = """
+<div class="card" style="margin-top:10px;">
+เป็นราคาจากแอพ Lalamove ณ วันที่สั่ง วันส่งอาจมีเปลี่ยนแปลงได้ ขึ้นอยู่กับการจราจร/ฝนตก
+<br><br>
+📍 ทางร้านเพียงอำนวยความสะดวกในการเรียกรถ ไม่ใช่คนขับของทางร้าน<br>
+❌ ทั้งนี้หากเกิดความล่าช้าหรือความเสียหายในระหว่างการจัดส่ง ทางร้านขอสงวนสิทธิ์ไม่รับผิดชอบในทุกกรณี
+<br><br>
+🩵 โปรดเลือกวิธีจัดส่งให้เหมาะสมกับระยะทาง ขนาดและแบบเค้ก
+</div>
+"""
+
+# one combined payload -> one element / one ForwardMsg for the page chrome
+_PAGE_CHROME_HTML = _PAGE_CSS + _HEADER_HTML
+
+# =========================
+# UI
+# =========================
+st.set_page_config(page_title="เช็คค่าส่ง", page_icon="🛵🚗", layout="wide")
+
+st.html(_PAGE_CHROME_HTML)
+
+# optional heavy UI stays out of the main graph when switched off
+_show_map = st.sidebar.toggle("🗺️ แสดงแผนที่ตัวอย่าง", key="show_map", value=True)
 
 ss = st.session_state
 ss.setdefault("search_results", [])
 ss.setdefault("selected_idx", 0)
 ss.setdefault("last_quote", None)
+ss.setdefault("quotes", {})
 ss.setdefault("vehicle", "MOTORCYCLE")
 ss.setdefault("dest", None)
 
 colL, colR = st.columns([7,5])
 
 with colL:
-    q = st.text_input("📍 ปลายทาง", placeholder="ใส่ link google map เท่านั้น")
+    # form: typing in the input no longer reruns the script, only submit does
+    with st.form("search_form"):
+        q = st.text_input("📍 ปลายทาง", placeholder="ใส่ link google map เท่านั้น")
+        submitted = st.form_submit_button("🔎 ค้นหา", use_container_width=True)
 
+    # vehicle stays outside the form so toggling swaps the cached price instantly
     vehicle_display = st.selectbox("ประเภทรถ", ["🛵 มอเตอร์ไซค์", "🚗 รถยนต์"], index=0)
     ss.vehicle = "MOTORCYCLE" if vehicle_display.startswith("🛵") else "CAR"
+    vehicle_changed = ss.vehicle != ss.get("_prev_vehicle")
+    ss["_prev_vehicle"] = ss.vehicle
 
-    if st.button("🔎 ค้นหา", use_container_width=True):
+    if submitted:
         try:
             with st.spinner("กำลังค้นหา/แปลงพิกัด…"):
                 resolved = resolve_destination(q.strip())
                 ss.last_quote = None
+                ss.quotes = {}
                 if not resolved:
                     ss.search_results = []
                     ss.dest = None
@@ -181,13 +298,15 @@ with colL:
                     ss.dest = {"label": resolved["label"], "lat": resolved["lat"], "lng": resolved["lng"]}
                     ss.search_results = [ss.dest]
                     ss.selected_idx = 0
+                    ss["_prefetch"] = _prefetch_quotes(ss.dest)  # warm both vehicle quotes in the background
                     st.success(f"ปลายทาง: {ss.dest['label'][:120]}")
         except Exception as e:
             st.error("เกิดข้อผิดพลาดในการค้นหา/แปลงพิกัด")
             st.caption(str(e))
 
 with colR:
-    if ss.get("dest"):
+    if ss.get("dest") and _show_map:
+        import pydeck as pdk  # lazy: only pay the import when there is a map to draw
         # Small preview map with a path line (height ~ 200px)
         shop = [SHOP_LAT, SHOP_LNG]
         dst  = [ss["dest"]["lat"], ss["dest"]["lng"]]
@@ -201,66 +320,69 @@ with colR:
                       get_path="path", width_scale=2, width_min_pixels=2)
         ]
         st.pydeck_chart(pdk.Deck(map_style="light", initial_view_state=view, layers=layers), use_container_width=True, height=200)
-    else:
+    elif not ss.get("dest"):
         st.caption("ยังไม่มีปลายทางที่เลือก")
 
 # Primary purple button (big)
 quote_clicked = st.button("เช็คค่าส่ง", type="primary", use_container_width=True, disabled=not bool(ss.get("dest")))
 
 if quote_clicked and ss.get("dest"):
-    try:
-        sel = ss["dest"]
-        stops = [
-            {"coordinates":{"lat":f"{SHOP_LAT}","lng":f"{SHOP_LNG}"},"address":SHOP_ADDR},
-            {"coordinates":{"lat":f"{sel['lat']}","lng":f"{sel['lng']}"},"address":sel["label"][:120]},
-        ]
-        item = {"quantity":"1","weight":"LESS_THAN_3_KG","categories":["FOOD_DELIVERY"],"handlingInstructions":["KEEP_UPRIGHT"]}
-        with st.spinner("กำลังคำนวณราคา…"):
-            ss.last_quote = get_quotation(stops=stops, service_type=ss.vehicle, language="th_TH", item=item, isRouteOptimized=False)
-    except Exception as e:
-        ss.last_quote = None
+    with st.spinner("กำลังคำนวณราคา…"):
+        # consume once: a later click must not re-read failed or TTL-stale futures
+        futs = ss.pop("_prefetch", None) or _prefetch_quotes(ss["dest"])
+        quotes, errors = {}, {}
+        for svc, f in futs.items():  # one vehicle failing must not take down the other
+            try: quotes[svc] = f.result(timeout=20)
+            except Exception as e: quotes[svc] = None; errors[svc] = e  # record the failure
+        ss.quotes = quotes
+        ss.last_quote = quotes.get(ss.vehicle)
+    if ss.last_quote is None:
         st.error("คำนวณราคาไม่สำเร็จ")
         with st.expander("รายละเอียดข้อผิดพลาด", expanded=False):
-            st.code(str(e))
+            st.code(str(errors.get(ss.vehicle, "")))
 
 # ===== Result + Bullet Summary =====
-if ss.get("last_quote"):
-    data = ss["last_quote"]
-    pb = data.get("priceBreakdown") or {}
-    total = pb.get("total")
-    currency = pb.get("currency","THB")
-    dist_m = (data.get("distance") or {}).get("value")
-    km_txt = f"{(int(dist_m)/1000):.1f} กม." if dist_m else "—"
-    dest_label = ss["dest"]["label"] if ss.get("dest") else "—"
-    vehicle_th = "มอเตอร์ไซค์" if ss.vehicle=="MOTORCYCLE" else "รถยนต์"
-
-
-    st.markdown(
-        f"""
-        <div style="display:flex;align-items:baseline;gap:10px;margin-top:8px;">
-        <div style="font-size:40px;font-weight:900;letter-spacing:-.02em;">
-            ฿{total if total else '—'}
-        </div>
-        <div style="color:#6b7280;">{currency}</div>
-        </div>
-        """,
-        unsafe_allow_html=True,
-    )
-
-    # Bullets สรุปรายการ (ไม่ใส่ราคาซ้ำ เพราะแสดงไว้ข้างบนแล้ว)
-    st.markdown(
-        f"- **ปลายทาง:** {dest_label[:140]}\n"
-        f"- **ระยะทาง:** {km_txt}\n"
-        f"- **วิธีจัดส่ง:** {vehicle_th}\n"
-    )
-
-    st.markdown("""
-<div class="card" style="margin-top:10px;">
-เป็นราคาจากแอพ Lalamove ณ วันที่สั่ง วันส่งอาจมีเปลี่ยนแปลงได้ ขึ้นอยู่กับการจราจร/ฝนตก
+if ss.get("dest") and ss.quotes:
+    data = ss.quotes.get(ss.vehicle)  # toggling vehicle swaps price instantly; None = recorded failure
+    if data is None and vehicle_changed and not quote_clicked:
+        try:  # retry a failed vehicle only when the user just toggled to it
+            with st.spinner("กำลังคำนวณราคา…"):
+                data = get_quotation(stops=_build_stops(ss["dest"]), service_type=ss.vehicle,
+                                     language="th_TH", item=QUOTE_ITEM, isRouteOptimized=False)
+            ss.quotes[ss.vehicle] = data
+        except Exception as e:
+            ss.quotes[ss.vehicle] = None
+            st.error("คำนวณราคาไม่สำเร็จ")
+            with st.expander("รายละเอียดข้อผิดพลาด", expanded=False):
+                st.code(str(e))
 
-📍 ทางร้านเพียงอำนวยความสะดวกในการเรียกรถ ไม่ใช่คนขับของทางร้าน  
-❌ ทั้งนี้หากเกิดความล่าช้าหรือความเสียหายในระหว่างการจัดส่ง ทางร้านขอสงวนสิทธิ์ไม่รับผิดชอบในทุกกรณี
+    if data:
+        pb = data.get("priceBreakdown") or {}
+        total = pb.get("total")
+        currency = pb.get("currency","THB")
+        dist_m = (data.get("distance") or {}).get("value")
+        km_txt = f"{(int(dist_m)/1000):.1f} กม." if dist_m else "—"
+        dest_label = ss["dest"]["label"] if ss.get("dest") else "—"
+        vehicle_th = "มอเตอร์ไซค์" if ss.vehicle=="MOTORCYCLE" else "รถยนต์"
 
-🩵 โปรดเลือกวิธีจัดส่งให้เหมาะสมกับระยะทาง ขนาดและแบบเค้ก
-</div>
-""", unsafe_allow_html=True)
\ No newline at end of file
+
+        st.markdown(
+            f"""
+            <div style="display:flex;align-items:baseline;gap:10px;margin-top:8px;">
+            <div style="font-size:40px;font-weight:900;letter-spacing:-.02em;">
+                ฿{total if total else '—'}
+            </div>
+            <div style="color:#6b7280;">{currency}</div>
+            </div>
+            """,
+            unsafe_allow_html=True,
+        )
+
+        # Bullets สรุปรายการ (ไม่ใส่ราคาซ้ำ เพราะแสดงไว้ข้างบนแล้ว)
+        st.markdown(
+            f"- **ปลายทาง:** {dest_label[:140]}\n"
+            f"- **ระยะทาง:** {km_txt}\n"
+            f"- **วิธีจัดส่ง:** {vehicle_th}\n"
+        )
+
+        st.html(_DISCLAIMER_HTML)
\ No newline at end of file